@@ -4,15 +4,26 @@ Proporciona utilidades para consultar diferentes tipos de eventos y métricas
 a través de la API de Amplitude.
 """
 import pandas as pd
+import numpy as np
 import json
+import os
 import requests
 from requests.auth import HTTPBasicAuth
+from dotenv import load_dotenv
 from amplitude_filters import (
     get_device_type,
     get_traffic_type,
     get_culture_digital_filter,
     get_DB_filter
 )
+from dataframe_schema import (
+    apply_schema,
+    concat_with_schema
+)
+
+load_dotenv()
+api_key = os.getenv('AMPLITUDE_API_KEY')
+secret_key = os.getenv('AMPLITUDE_SECRET_KEY')
 
 # Obtener el tiempo de compra de un funnel (la convención ahora es tener desde el Home o Flights)
 def get_TTC_client_journey(api_key, secret_key, start_date, end_date, culture, device, conversion_window_seconds=86400):
@@ -66,9 +77,9 @@ def get_TTC_client_journey(api_key, secret_key, start_date, end_date, culture, d
 
 
 
-def get_api_events_segment_data(start_date, end_date, api_key, secret_key):
+def get_api_events_segment_data(start_date, end_date, api_key, secret_key, start_hour=None, end_hour=None):
     """
-    Realiza una llamada a la API de Amplitude para obtener datos de eventos
+    Realiza una llamada a la API de Amplitude para obtener datos de eventos por hora
     
     Parameters
     ----------
@@ -80,6 +91,11 @@ def get_api_events_segment_data(start_date, end_date, api_key, secret_key):
         La clave de API para la autenticación en la API de Amplitude.
     secret_key : str
         La clave secreta para la autenticación en la API de Amplitude.
+    start_hour (optional) : int
+        Parámetro opcional. Primera hora (0 a 23) de start_date que se quiere obtener. Si es None se obtiene desde las 00:00.
+    end_hour (optional) : int
+        Parámetro opcional. Última hora (0 a 23) de end_date que se quiere obtener. Si es None se obtiene hasta las 23:59.
+        Con start_hour y end_hour se pide a Amplitude solo un rango de buckets horarios, lo que reduce el tamaño de la respuesta.
          
     Returns
     -------
@@ -95,10 +111,18 @@ def get_api_events_segment_data(start_date, end_date, api_key, secret_key):
     }
 
     
+    start = str(start_date).replace('-','')
+    end = str(end_date).replace('-','')
+    # Amplitude acepta el formato YYYYMMDDTHH para consultas por hora
+    if start_hour is not None:
+        start = f'{start}T{start_hour:02d}'
+    if end_hour is not None:
+        end = f'{end}T{end_hour:02d}'
+
     params = {
         'e': json.dumps(event_filter),
-        'start': str(start_date).replace('-',''),
-        'end': str(end_date).replace('-',''),
+        'start': start,
+        'end': end,
         'limit': 20000,
         'i': -3600000 # -> esto es para sacar la data por hora
     }
@@ -108,8 +132,68 @@ def get_api_events_segment_data(start_date, end_date, api_key, secret_key):
 
     response = requests.get(url, headers=headers, params=params, auth=auth, verify=False)
 
+    # Check for errors in the response
+    if response.status_code != 200:
+        print(f"Error: {response.status_code}")
+        print(f"Response: {response.text}")
+        response.raise_for_status()
+
     return json.loads(response.text)
 
+def parse_looks_per_hour(data, hour_filter=23, start_hour=0):
+    """
+    Transforma la respuesta de get_api_events_segment_data() en un dataframe con las looks por ruta y hora
+    
+    Parameters
+    ----------
+    data : dict
+        La respuesta de la API de segmentación de Amplitude agrupada por ruta.
+    hour_filter (optional) : int
+        Parámetro opcional. La hora máxima (0 a 23, incluida) que se quiere mantener.
+    start_hour (optional) : int
+        Parámetro opcional. La hora mínima (0 a 23, incluida) que se quiere mantener.
+         
+    Returns
+    -------
+    df
+        Un dataframe con las columnas Date, Origin, Destination y Looks, con un registro por ruta y hora
+    """
+    looks_per_hour = data['data']['series']
+    dates_per_hour = data['data']['xValues']
+    routes = [element[1] for element in data['data']['seriesLabels']]
+    hours = [pd.Timestamp(date).hour for date in dates_per_hour]
+
+    rows = []
+    for looks, route in zip(looks_per_hour, routes):
+        if 'n/a' in route:
+            continue
+        origin = route.split('-')[0]
+        destination = route.split('-')[1]
+        for date, hour, look in zip(dates_per_hour, hours, looks):
+            if hour < start_hour or hour > hour_filter:
+                continue
+            rows.append({'Date': date,
+                         'Origin': origin,
+                         'Destination': destination,
+                         'Looks': look})
+
+    return pd.DataFrame(rows, columns=['Date', 'Origin', 'Destination', 'Looks'])
+
+def add_rt_market(df):
+    """
+    Agrega la columna RTMarket a un dataframe de looks por ruta, dejando ida y vuelta bajo un mismo identificador
+    (ANF-SCL y SCL-ANF quedan como ANFSCL)
+    """
+    df = df.copy()
+    df['Origin'] = df['Origin'].replace({'AEP': 'BUE', 'EZE': 'BUE', 'GIG': 'RIO'}, regex=True)
+    df['Destination'] = df['Destination'].replace({'AEP': 'BUE', 'EZE': 'BUE', 'GIG': 'RIO'}, regex=True)
+
+    # Creamos el RTMarket de manera vectorizada
+    df['RTMarket'] = np.where(df['Origin'] < df['Destination'],
+                                     df['Origin'] + df['Destination'],
+                                     df['Destination'] + df['Origin'])
+    return df
+
 def get_data_looks_per_route(dates_list, hour_filter=23, return_per_hour=False):  #el hour filter debe ser HASTA la hora X, ej hour_filter=23 filtra todo el día
     """
     Obtiene los datos de la API de Amplitude usando la función get_api_events_segment_data() y luego 
@@ -134,42 +218,20 @@ def get_data_looks_per_route(dates_list, hour_filter=23, return_per_hour=False):
         Un dataframe en donde cada registro indica las looks del RTMarket de todas las rutas
         que se han cotizado según las fechas y horas especificadas
     """
-    df = pd.DataFrame(columns=['Date', 'Origin', 'Destination', 'Looks'])
-
+    # Se aplica el esquema compacto a cada fecha antes de concatenar, para no tener nunca
+    # el dataframe completo con strings y enteros de 64 bits en memoria
+    chunks = []
     for date in dates_list:
         data = get_api_events_segment_data(date,
                                                str(date).replace('-',''),
                                                api_key,
                                                secret_key)
-        
-        looks_per_hour = data['data']['series']
-        dates_per_hour = data['data']['xValues']
-        routes = [element[1] for element in data['data']['seriesLabels']]
-        
-        for looks, route in zip(looks_per_hour, routes):
-            if 'n/a' not in route:
-                i = 0
-                for date, look in zip(dates_per_hour, looks):
-                    if i > hour_filter:
-                        break
-                    else:
-                        origin = route.split('-')[0]
-                        destination  = route.split('-')[1]
-                        df = df._append({'Date': date, 
-                                        'Origin': origin, 
-                                        'Destination': destination,
-                                        'Looks': look
-                                    }, ignore_index=True)
-                    i += 1
-    
-    # Se deja a nivel RT_Market (agrega la idea y vuelta 1 sola -> ANF-SCL y SCL-ANF queda ANFSCL)
-    df['Origin'] = df['Origin'].replace({'AEP': 'BUE', 'EZE': 'BUE', 'GIG': 'RIO'}, regex=True)
-    df['Destination'] = df['Destination'].replace({'AEP': 'BUE', 'EZE': 'BUE', 'GIG': 'RIO'}, regex=True)
+        chunks.append(apply_schema(add_rt_market(parse_looks_per_hour(data, hour_filter))))
 
-    # Creamos el RTMarket de manera vectorizada
-    df['RTMarket'] = np.where(df['Origin'] < df['Destination'],
-                                     df['Origin'] + df['Destination'],
-                                     df['Destination'] + df['Origin'])
+    if chunks:
+        df = concat_with_schema(chunks)
+    else:
+        df = pd.DataFrame(columns=['Date', 'Origin', 'Destination', 'Looks', 'RTMarket'])
  
     # preguntamos si se quiere retornar por hora o no
     if return_per_hour:
@@ -178,21 +240,19 @@ def get_data_looks_per_route(dates_list, hour_filter=23, return_per_hour=False):
         # Transformamos a YYYY-MM-DD
         df['Date'] = pd.to_datetime(df['Date']).dt.strftime('%Y-%m-%d')
         
-        df_final = df.groupby(['Date', 'RTMarket']).sum()
+        df_final = df.groupby(['Date', 'RTMarket'], observed=True)[['Looks']].sum()
         df_final = df_final.reset_index()
-        # df_final = df_final[['Date', 'RTMarket', 'Looks']]
 
-        return df_final, df_per_hour
+        return apply_schema(df_final), df_per_hour
     else:
         # Transformamos a YYYY-MM-DD
         df['Date'] = pd.to_datetime(df['Date']).dt.strftime('%Y-%m-%d')
 
         # agrupamos las looks
-        df_final = df.groupby(['Date', 'RTMarket']).sum()
+        df_final = df.groupby(['Date', 'RTMarket'], observed=True)[['Looks']].sum()
         df_final = df_final.reset_index()
-        # df_final = df_final[['Date', 'RTMarket', 'Looks']]
 
-        return df_final
+        return apply_schema(df_final)
 
 
 # # Ejemplo de uso
@@ -172,4 +172,7 @@ def get_cultures():
     return [
         "CL", "AR", "PE", "CO", "BR", 
         "UY", "PY", "EC", "US", # quitamos others
-    ]
\ No newline at end of file
+    ]
+
+def get_devices():
+    return ['desktop', 'mobile']
\ No newline at end of file
@@ -2,6 +2,7 @@ from fastapi import FastAPI, Query
 from typing import Optional
 import pandas as pd
 from api.conversion_only_culture import create_client_TTC_dataframe
+from api.dataframe_schema import apply_schema
 from database_functions import (
     get_database_connection,
 )
@@ -46,7 +47,7 @@ def get_historical(
         params["device"] = device
     with engine.connect() as conn:
         result = conn.execute(text(query), params)
-        df = pd.DataFrame(result.fetchall(), columns=result.keys())
+        df = apply_schema(pd.DataFrame(result.fetchall(), columns=result.keys()))
     if df.empty:
         return []
     df = calculate_conversion(df)
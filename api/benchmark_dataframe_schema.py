@@ -0,0 +1,90 @@
+"""
+Benchmark del uso de memoria de los DataFrames con y sin el esquema de dataframe_schema.py.
+Genera data sintética con la misma forma que los reportes de looks por ruta (por hora) y del funnel
+por culture/device, y compara la memoria (deep) de ambos.
+
+Uso:
+    python benchmark_dataframe_schema.py --days 30 --routes 2000
+"""
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from amplitude_filters import (
+    get_cultures,
+    get_devices
+)
+from dataframe_schema import apply_schema
+
+
+def build_looks_per_hour_frame(days, routes, seed=0):
+    """
+    Crea un dataframe sintético de looks por ruta y hora con columnas Date, Origin, Destination, Looks y RTMarket
+    """
+    rng = np.random.default_rng(seed)
+    airports = [f'{a}{b}{c}' for a in 'ABCDEFGH' for b in 'ABCDEFGH' for c in 'AB']
+    origins = rng.choice(airports, size=routes)
+    destinations = rng.choice(airports, size=routes)
+
+    hours = pd.date_range('2025-01-01', periods=days * 24, freq='h').strftime('%Y-%m-%dT%H:%M:%S')
+    n_rows = len(hours) * routes
+
+    df = pd.DataFrame({
+        'Date': np.repeat(hours.to_numpy(), routes),
+        'Origin': np.tile(origins, len(hours)).astype(object),
+        'Destination': np.tile(destinations, len(hours)).astype(object),
+        'Looks': rng.poisson(20, size=n_rows).astype('int64'),
+    })
+    df['RTMarket'] = np.where(df['Origin'] < df['Destination'],
+                              df['Origin'] + df['Destination'],
+                              df['Destination'] + df['Origin'])
+    return df
+
+
+def build_funnel_frame(days, seed=0):
+    """
+    Crea un dataframe sintético del funnel diario por culture y device
+    """
+    rng = np.random.default_rng(seed)
+    combinations = [(culture, device) for culture in get_cultures() for device in get_devices()]
+    dates = pd.date_range('2025-01-01', periods=days, freq='D')
+    rows = [(date, culture, device) for date in dates for culture, device in combinations]
+
+    df = pd.DataFrame(rows, columns=['date', 'culture', 'device'])
+    df['traffic'] = rng.integers(1000, 200000, size=len(df)).astype('int64')
+    df['flight_dom_loaded_flight'] = (df['traffic'] * 0.4).astype('int64')
+    df['payment_confirmation_loaded'] = (df['traffic'] * 0.02).astype('int64')
+    return df
+
+
+def measure(name, df):
+    start_time = time.time()
+    compact = apply_schema(df)
+    elapsed = time.time() - start_time
+
+    # Memoria por columna (sin el índice), para ver qué columnas dominan antes y después
+    breakdown = pd.DataFrame({
+        'dtype_antes': df.dtypes.astype(str),
+        'MB_antes': df.memory_usage(deep=True, index=False) / 1024 ** 2,
+        'dtype_despues': compact.dtypes.astype(str),
+        'MB_despues': compact.memory_usage(deep=True, index=False) / 1024 ** 2,
+    })
+    before = breakdown['MB_antes'].sum()
+    after = breakdown['MB_despues'].sum()
+
+    print(f'{name}: {len(df):,} filas')
+    print(f'  sin esquema: {before:,.1f} MB')
+    print(f'  con esquema: {after:,.1f} MB ({after / before:.1%}) en {elapsed:.2f} s')
+    print(breakdown.round(2).to_string())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--routes', type=int, default=2000)
+    args = parser.parse_args()
+
+    measure('Looks por ruta y hora', build_looks_per_hour_frame(args.days, args.routes))
+    measure('Funnel por culture y device', build_funnel_frame(args.days))
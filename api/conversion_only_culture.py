@@ -20,6 +20,11 @@ from amplitude_events import (
     get_TTC_client_journey
 )
 
+from dataframe_schema import (
+    apply_schema,
+    concat_with_schema
+)
+
 load_dotenv()
 api_key = os.getenv('AMPLITUDE_API_KEY')
 secret_key = os.getenv('AMPLITUDE_SECRET_KEY')
@@ -61,12 +66,12 @@ def create_client_TTC_dataframe(start_date, end_date, culture):
         'payment_confirmation_loaded',
     ]
     df = df[columns_order]
-    return df
+    return apply_schema(df)
 
 
 def final_pipeline_client_journey(start_date, end_date):
     start_time = time.time()
-    df_final = pd.DataFrame()
+    chunks = []
     filters = get_filters_culture_device()
 
     
@@ -78,7 +83,10 @@ def final_pipeline_client_journey(start_date, end_date):
             end_date,
             culture,
         )
-        df_final = pd.concat([df_final, df_temp], axis=0)
+        chunks.append(df_temp)
+
+    # create_client_TTC_dataframe ya entrega cada bloque con el esquema aplicado
+    df_final = concat_with_schema(chunks)
 
     end_time = time.time()
     print(end_time - start_time)
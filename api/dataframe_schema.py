@@ -0,0 +1,95 @@
+"""
+Módulo con el esquema de tipos compartido para los DataFrames del proyecto.
+Convierte las columnas de baja cardinalidad (culture, device, Origin, Destination, RTMarket)
+a categóricas, las fechas a datetime64 y reduce los contadores al tipo entero más pequeño que los contiene.
+"""
+import numpy as np
+import pandas as pd
+
+from amplitude_filters import (
+    get_cultures,
+    get_devices
+)
+
+# Columnas categóricas con vocabulario conocido
+KNOWN_VOCABULARIES = {
+    'culture': get_cultures(),
+    'device': get_devices(),
+}
+
+# Columnas categóricas cuyo vocabulario (aeropuertos / mercados) se toma desde la data
+MARKET_COLUMNS = ['Origin', 'Destination', 'RTMarket']
+
+# Columnas de fecha (vienen como strings desde Amplitude, ej: 2025-04-08T00:00:00)
+DATE_COLUMNS = ['Date', 'date']
+
+# Contadores que se pueden reducir a enteros con signo, con el tipo mínimo de cada uno.
+# Con signo para que restas como payment_confirmation_loaded - traffic den negativos y no den la vuelta;
+# los del funnel quedan en int32 como mínimo porque se combinan entre sí para calcular caídas y tasas
+COUNTER_COLUMNS = {
+    'Looks': 'int16',
+    'traffic': 'int32',
+    'flight_dom_loaded_flight': 'int32',
+    'payment_confirmation_loaded': 'int32',
+}
+
+
+def get_categorical_dtype(column, values):
+    """
+    Retorna el CategoricalDtype para una columna. Si la columna tiene vocabulario conocido,
+    este va primero y se agregan al final los valores que no estén en él, para no perder datos.
+    """
+    known = KNOWN_VOCABULARIES.get(column, [])
+    extra = sorted(set(values.dropna()) - set(known))
+    return pd.CategoricalDtype(categories=known + extra)
+
+
+def downcast_counter(series, min_dtype='int8'):
+    """
+    Reduce un contador al tipo entero con signo más pequeño que lo contiene, sin bajar de min_dtype.
+    Si la columna tiene nulos o valores no enteros se deja tal cual.
+    """
+    numeric = pd.to_numeric(series, errors='coerce')
+    if numeric.isna().any() or not (numeric == numeric.round()).all():
+        return series
+    downcasted = pd.to_numeric(numeric.astype('int64'), downcast='integer')
+    return downcasted.astype(np.promote_types(downcasted.dtype, min_dtype))
+
+
+def apply_schema(df):
+    """
+    Aplica el esquema compacto a las columnas conocidas del dataframe y deja el resto sin cambios.
+
+    OJO: las columnas categóricas se deben agrupar con observed=True.
+    """
+    df = df.copy()
+    for column in DATE_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column])
+    for column in list(KNOWN_VOCABULARIES) + MARKET_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype(get_categorical_dtype(column, df[column]))
+    for column, min_dtype in COUNTER_COLUMNS.items():
+        if column in df.columns:
+            df[column] = downcast_counter(df[column], min_dtype)
+    return df
+
+
+def concat_with_schema(frames):
+    """
+    Concatena dataframes a los que ya se les aplicó apply_schema() sin perder las categóricas:
+    las categorías de cada columna se unifican antes del concat (si difieren, pandas vuelve a object).
+    Permite aplicar el esquema por bloque (ej: por fecha) y no recién sobre el dataframe completo.
+    """
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame()
+
+    for column in list(KNOWN_VOCABULARIES) + MARKET_COLUMNS:
+        if all(isinstance(frame.get(column, pd.Series()).dtype, pd.CategoricalDtype) for frame in frames):
+            known = KNOWN_VOCABULARIES.get(column, [])
+            observed = set().union(*[frame[column].cat.categories for frame in frames])
+            categories = known + sorted(observed - set(known))
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,208 @@
+"""
+Módulo para el refresco intradía incremental del reporte de Looks por ruta.
+Mantiene en disco la data por hora del día en curso y, en cada refresco, solo consulta
+a Amplitude los buckets horarios que aún no se consideran cerrados.
+"""
+import os
+import time
+import pickle
+import datetime
+from zoneinfo import ZoneInfo
+
+import pandas as pd
+from dotenv import load_dotenv
+
+from amplitude_events import (
+    get_api_events_segment_data,
+    parse_looks_per_hour,
+    add_rt_market
+)
+from dataframe_schema import (
+    apply_schema,
+    concat_with_schema
+)
+
+load_dotenv()
+api_key = os.getenv('AMPLITUDE_API_KEY')
+secret_key = os.getenv('AMPLITUDE_SECRET_KEY')
+
+# Todas las horas del reporte son en hora Chile
+TIMEZONE = ZoneInfo('America/Santiago')
+
+STORE_PATH = os.getenv('LOOKS_INTRADAY_STORE_PATH', 'looks_per_route_intraday.pkl')
+LOCK_PATH = f'{STORE_PATH}.lock'
+
+# Horas ya terminadas que se vuelven a pedir para capturar eventos que llegan tarde
+REOPEN_HOURS = int(os.getenv('LOOKS_INTRADAY_REOPEN_HOURS', 2))
+REFRESH_INTERVAL_SECONDS = int(os.getenv('LOOKS_INTRADAY_REFRESH_SECONDS', 3600))
+# Cantidad de fechas que se mantienen en el almacenamiento (el día en curso y el anterior)
+STORE_DAYS = 2
+# Un lock más antiguo que esto se considera abandonado (proceso caído)
+LOCK_STALE_SECONDS = 3 * REFRESH_INTERVAL_SECONDS
+
+
+def read_store(store_path=STORE_PATH):
+    """
+    Lee el almacenamiento completo: un diccionario {fecha: {'final_until': int, 'per_hour': df}}
+    """
+    if not os.path.exists(store_path):
+        return {}
+    with open(store_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def load_intraday_store(date, store_path=STORE_PATH):
+    """
+    Carga la data por hora almacenada para la fecha indicada.
+
+    Returns
+    -------
+    tuple
+        (df_per_hour, final_until), donde final_until es la última hora (0 a 23) que ya se considera
+        cerrada, o -1 si no hay horas cerradas. Si la fecha no está almacenada se parte de cero.
+    """
+    store = read_store(store_path)
+    if date not in store:
+        return pd.DataFrame(columns=['Date', 'Origin', 'Destination', 'Looks', 'RTMarket']), -1
+
+    return store[date]['per_hour'], store[date]['final_until']
+
+
+def save_intraday_store(date, df_per_hour, final_until, store_path=STORE_PATH):
+    """
+    Guarda la data por hora de la fecha de forma atómica (se escribe a un archivo temporal y luego se reemplaza).
+    Se mantienen solo las STORE_DAYS fechas más recientes, además de la fecha guardada.
+    """
+    store = read_store(store_path)
+    store[date] = {'final_until': final_until, 'per_hour': df_per_hour}
+    recent_dates = sorted(store)[-STORE_DAYS:]
+    store = {d: v for d, v in store.items() if d in recent_dates or d == date}
+
+    tmp_path = f'{store_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(store, f)
+    os.replace(tmp_path, store_path)
+
+
+def get_hour_windows(date, now, reopen_hours=REOPEN_HOURS):
+    """
+    Calcula, para una fecha y un instante dado, la última hora disponible y la última hora cerrada.
+
+    Una hora h se considera cerrada cuando ya pasaron reopen_hours horas desde su término,
+    es decir, cuando h + 1 + reopen_hours <= horas transcurridas desde el inicio del día.
+
+    Returns
+    -------
+    tuple
+        (last_hour, final_until). last_hour es -1 si el día aún no comienza y final_until es -1 si no hay horas cerradas.
+    """
+    day_start = datetime.datetime.combine(datetime.date.fromisoformat(date), datetime.time(0), tzinfo=TIMEZONE)
+    elapsed_hours = int((now - day_start).total_seconds() // 3600)
+
+    last_hour = min(elapsed_hours, 23)
+    final_until = min(elapsed_hours - 1 - reopen_hours, 23)
+    return last_hour, max(final_until, -1)
+
+
+def refresh_looks_per_route_intraday(date=None, reopen_hours=REOPEN_HOURS, store_path=STORE_PATH, now=None):
+    """
+    Refresca de forma incremental las looks por ruta del día, pidiendo a Amplitude solo las horas
+    abiertas o nuevas y mezclándolas con la data por hora ya almacenada.
+
+    Parameters
+    ----------
+    date (optional) : str
+        Fecha en formato YYYY-MM-DD que se quiere refrescar. Por defecto es el día en curso (hora Chile).
+    reopen_hours (optional) : int
+        Cantidad de horas ya terminadas que se vuelven a pedir para capturar eventos que llegan tarde.
+    store_path (optional) : str
+        Ruta del archivo donde se almacena la data por hora.
+    now (optional) : datetime
+        Instante de referencia (con zona horaria). Por defecto es el instante actual.
+
+    Returns
+    -------
+    tuple
+        (df_final, df_per_hour) con el mismo formato que get_data_looks_per_route(return_per_hour=True)
+    """
+    now = now or datetime.datetime.now(TIMEZONE)
+    date = date or now.astimezone(TIMEZONE).date().isoformat()
+
+    df_per_hour, stored_final_until = load_intraday_store(date, store_path)
+    last_hour, final_until = get_hour_windows(date, now, reopen_hours)
+
+    # Se piden solo las horas que no están cerradas en el almacenamiento
+    start_hour = stored_final_until + 1
+    if start_hour <= last_hour:
+        data = get_api_events_segment_data(date,
+                                           date,
+                                           api_key,
+                                           secret_key,
+                                           start_hour=start_hour,
+                                           end_hour=last_hour)
+        # Se filtra por hora por si la API entrega más buckets que los pedidos, para no duplicar looks
+        df_new = apply_schema(add_rt_market(parse_looks_per_hour(data, hour_filter=last_hour, start_hour=start_hour)))
+        print(f'Refrescando {date} desde las {start_hour:02d}:00 hasta las {last_hour:02d}:59 ({len(df_new)} registros)')
+
+        df_kept = df_per_hour[pd.to_datetime(df_per_hour['Date']).dt.hour < start_hour]
+        df_per_hour = concat_with_schema([apply_schema(df_kept), df_new])
+
+        save_intraday_store(date, df_per_hour, max(stored_final_until, final_until), store_path)
+
+    df_final = df_per_hour.copy()
+    df_final['Date'] = pd.to_datetime(df_final['Date']).dt.strftime('%Y-%m-%d')
+    df_final = df_final.groupby(['Date', 'RTMarket'], as_index=False, observed=True)['Looks'].sum()
+
+    return apply_schema(df_final), df_per_hour
+
+
+def acquire_lock(lock_path=LOCK_PATH):
+    """
+    Intenta tomar el lock del refresco intradía. Retorna False si otra ejecución lo tiene tomado.
+    """
+    if os.path.exists(lock_path) and time.time() - os.path.getmtime(lock_path) > LOCK_STALE_SECONDS:
+        os.remove(lock_path)
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def release_lock(lock_path=LOCK_PATH):
+    if os.path.exists(lock_path):
+        os.remove(lock_path)
+
+
+def run_intraday_scheduler(interval_seconds=REFRESH_INTERVAL_SECONDS, reopen_hours=REOPEN_HOURS):
+    """
+    Loop local que ejecuta refresh_looks_per_route_intraday() cada interval_seconds.
+    Si otra ejecución sigue en curso (lock tomado) se salta ese ciclo en vez de solaparse.
+
+    En cada ciclo se refresca también el día anterior, para que después de medianoche se completen
+    sus últimas horas (las que seguían abiertas). Si ya está cerrado no se llama a la API.
+    """
+    while True:
+        start_time = time.time()
+        if acquire_lock():
+            try:
+                now = datetime.datetime.now(TIMEZONE)
+                yesterday = (now.date() - datetime.timedelta(days=1)).isoformat()
+                # Cada fecha con su propio try: un error en el día anterior no debe saltarse el refresco del día en curso
+                for date in [yesterday, now.date().isoformat()]:
+                    try:
+                        refresh_looks_per_route_intraday(date=date, reopen_hours=reopen_hours, now=now)
+                    except Exception as e:
+                        print(f'Error en el refresco intradía de {date}: {e}')
+            finally:
+                release_lock()
+        else:
+            print('Hay un refresco intradía en curso, se salta este ciclo')
+
+        time.sleep(max(0, interval_seconds - (time.time() - start_time)))
+
+
+if __name__ == "__main__":
+    run_intraday_scheduler()
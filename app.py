@@ -1,4 +1,9 @@
 import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 import streamlit as st
 from sqlalchemy import text
 from dotenv import load_dotenv
@@ -15,12 +20,204 @@ if not OPENAI_API_KEY:
     st.error("❌ Error: No se encontró OPENAI_API_KEY en las variables de entorno")
     st.stop()
 
-# Configurar el cliente de OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Llamadas a OpenAI: límite global de llamadas simultáneas (entre todas las sesiones) y cache de respuestas
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv("MAX_CONCURRENT_LLM_CALLS", 4))
+LLM_MAX_RETRIES = 5
+LLM_CACHE_TTL_SECONDS = 600
+LLM_CACHE_MAX_ENTRIES = 500
 
+# Modo multi-consulta: límites del plan de sub-consultas
+MAX_SUBQUERIES = 6
+MAX_CONCURRENT_SUBQUERIES = 4
+MAX_ROWS_PER_SUBQUERY = 50
+SUBQUERY_TIMEOUT_SECONDS = 60
+# Margen sobre el statement_timeout de Postgres antes de dejar de esperar una sub-consulta que ya empezó
+SUBQUERY_TIMEOUT_GRACE_SECONDS = 5
+# Tiempo máximo que una sub-consulta puede esperar en cola (el executor es compartido por todas las sesiones)
+SUBQUERY_QUEUE_TIMEOUT_SECONDS = 120
+SUBQUERY_CACHE_TTL_SECONDS = 600
+SUBQUERY_CACHE_MAX_ENTRIES = 1000
+# Filas máximas de una consulta simple (modo normal) que se pasan al LLM y se cachean
+MAX_ROWS_PER_QUERY = 500
+
+TABLE_DESCRIPTION = """
+    La tabla 'client_conversion_only_culture' tiene estas columnas:
+    - date (datetime): fecha de la métrica
+    - culture (string): código de país (CL, AR, PE, CO, BR, UY, PY, EC, US)
+    - traffic (float): sesiones / usuarios únicos diarios
+    - flight_dom_loaded_flight (int): veces que se cargó la página de vuelos nacionales
+    - payment_confirmation_loaded (int): Total de usuarios únicos que completaron una transacción exitosa
+    - median_time_seconds (float): tiempo mediano hasta la conversión en segundos
+    - median_time_minutes (float): tiempo mediano en minutos hasta la conversión
+"""
+
+class TTLCache:
+    """
+    Cache LRU en memoria, segura entre threads, cuyas entradas expiran después de ttl segundos
+    y que guarda a lo más maxsize entradas (se descartan primero las usadas hace más tiempo)
+    """
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self._data.pop(key, None)
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            now = time.time()
+            # Se eliminan las entradas expiradas, no solo las que se vuelven a consultar
+            for expired_key in [k for k, (created_at, _) in self._data.items() if now - created_at > self.ttl]:
+                del self._data[expired_key]
+            self._data[key] = (now, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+class LeaderInterruptedError(RuntimeError):
+    """La sesión que ejecutaba una petición compartida fue interrumpida (rerun / stop) antes de terminar"""
+
+class RequestCoalescer:
+    """
+    Agrupa las peticiones idénticas que están en curso al mismo tiempo: la primera (leader) hace el trabajo
+    y las demás esperan su mismo resultado.
+    """
+    def __init__(self):
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def join(self, key):
+        """Retorna (future, is_leader). Si is_leader es True, quien llama debe resolver el future y luego llamar a done()"""
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def done(self, key, future):
+        with self._lock:
+            # Solo se quita si sigue siendo el mismo future (otra sesión puede haber tomado el relevo como leader)
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+# Recursos compartidos por todas las sesiones del proceso (no se recrean en cada rerun de Streamlit)
+@st.cache_resource
 def get_db_connection():
+    # Un solo engine (con su pool de conexiones) compartido por todas las consultas
     return get_database_connection()
 
+@st.cache_resource
+def get_openai_client():
+    # El cliente reintenta con backoff exponencial los errores de rate limit (429)
+    return OpenAI(api_key=OPENAI_API_KEY, max_retries=LLM_MAX_RETRIES)
+
+@st.cache_resource
+def get_llm_limiter():
+    return threading.BoundedSemaphore(MAX_CONCURRENT_LLM_CALLS)
+
+@st.cache_resource
+def get_llm_coalescer():
+    return RequestCoalescer()
+
+@st.cache_resource
+def get_llm_cache():
+    return TTLCache(LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_ENTRIES)
+
+@st.cache_resource
+def get_subquery_cache():
+    return TTLCache(SUBQUERY_CACHE_TTL_SECONDS, SUBQUERY_CACHE_MAX_ENTRIES)
+
+@st.cache_resource
+def get_subquery_executor():
+    # Un solo executor para todas las sesiones: MAX_CONCURRENT_SUBQUERIES es el límite total de sub-consultas en la BD
+    return ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SUBQUERIES, thread_name_prefix="subquery")
+
+def call_openai(prompt, temperature, **kwargs):
+    """
+    Llama a OpenAI respetando el límite global de llamadas simultáneas.
+    Si no hay cupo, la petición queda en cola mostrando el tiempo de espera al usuario.
+    """
+    limiter = get_llm_limiter()
+    acquired = limiter.acquire(blocking=False)
+    # Todo lo que viene después de tomar el cupo va dentro del try: Streamlit puede interrumpir la ejecución
+    # (rerun / stop) desde cualquier llamada st.*, y el cupo se debe liberar igual
+    try:
+        if not acquired:
+            start_time = time.time()
+            with st.status("En cola: hay otras consultas a OpenAI en curso...") as status:
+                while not limiter.acquire(timeout=1):
+                    status.update(label=f"En cola: esperando turno para consultar a OpenAI ({int(time.time() - start_time)} s)...")
+                acquired = True
+                status.update(label=f"Turno obtenido después de {int(time.time() - start_time)} s", state="complete")
+        response = get_openai_client().chat.completions.create(
+            model="gpt-4.1-mini",
+            messages=[{"role": "user", "content": prompt}],
+            temperature=temperature,
+            **kwargs
+        )
+        return response.choices[0].message.content
+    finally:
+        if acquired:
+            limiter.release()
+
+def call_llm(prompt, temperature, **kwargs):
+    """
+    Llama a OpenAI compartiendo el trabajo entre sesiones: las respuestas deterministas (temperature=0) se cachean
+    y las peticiones idénticas que están en curso al mismo tiempo se resuelven con una sola llamada.
+    """
+    key = json.dumps({"prompt": prompt, "temperature": temperature, **kwargs}, sort_keys=True)
+    cache = get_llm_cache()
+    if temperature == 0:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    coalescer = get_llm_coalescer()
+    while True:
+        future, is_leader = coalescer.join(key)
+        if is_leader:
+            break
+        try:
+            with st.spinner("Otra sesión está haciendo la misma consulta, esperando su respuesta..."):
+                return future.result()
+        except LeaderInterruptedError:
+            # La sesión que hacía la consulta se interrumpió: se vuelve a intentar, posiblemente como leader
+            continue
+
+    try:
+        content = call_openai(prompt, temperature, **kwargs)
+        if temperature == 0:
+            cache.set(key, content)
+        future.set_result(content)
+        return content
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    except BaseException:
+        # Rerun / stop de Streamlit: son propios de esta sesión y no se deben propagar a las que esperan,
+        # que reciben un error neutro y reintentan. Aquí se re-lanza la excepción original
+        future.set_exception(LeaderInterruptedError("la sesión que ejecutaba esta consulta fue interrumpida"))
+        raise
+    finally:
+        coalescer.done(key, future)
+
+def strip_code_fences(text):
+    text = text.strip()
+    if text.startswith('```'):
+        lines = text.split('\n')
+        text = '\n'.join(lines[1:-1]) if len(lines) > 2 else text
+    return text
+
 def generate_sql_query(question):
     """Genera una consulta SQL usando OpenAI"""
     prompt = f"""
@@ -34,55 +231,183 @@ def generate_sql_query(question):
     - Usa SOLO símbolos SQL estándar: >=, <=, =, !=, etc. (NO uses ≥, ≤, ≠)
     - NO incluyas markdown, comillas extra, o formato adicional
     - Responde SOLO con la consulta SQL pura
-    
-    La tabla 'client_conversion_only_culture' tiene estas columnas:
-    - date (datetime): fecha de la métrica
-    - culture (string): código de país (CL, AR, PE, CO, BR, UY, PY, EC, US)
-    - traffic (float): sesiones / usuarios únicos diarios
-    - flight_dom_loaded_flight (int): veces que se cargó la página de vuelos nacionales
-    - payment_confirmation_loaded (int): Total de usuarios únicos que completaron una transacción exitosa
-    - median_time_seconds (float): tiempo mediano hasta la conversión en segundos
-    - median_time_minutes (float): tiempo mediano en minutos hasta la conversión
-    
+    {TABLE_DESCRIPTION}
     Ejemplo de respuesta correcta con conversiones de tipos:
     SELECT culture, ROUND(AVG(median_time_seconds)::numeric, 2) as tiempo_medio FROM client_conversion_only_culture WHERE culture = 'CL' GROUP BY culture
     """
     
-    response = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0
-    )
-    
-    sql_query = response.choices[0].message.content.strip()
-    if sql_query.startswith('```'):
-        lines = sql_query.split('\n')
-        sql_query = '\n'.join(lines[1:-1]) if len(lines) > 2 else sql_query
-    
-    return sql_query
+    return strip_code_fences(call_llm(prompt, temperature=0))
 
-def execute_query(sql_query):
-    """Ejecuta la consulta SQL y retorna los resultados"""
-    engine = get_db_connection()
+def generate_query_plan(question):
+    """Genera con OpenAI un plan de sub-consultas SQL independientes y parametrizadas para preguntas compuestas"""
+    prompt = f"""
+    Eres un experto en SQL para PostgreSQL. Descompón esta pregunta en sub-consultas SQL INDEPENDIENTES entre sí
+    (ninguna usa el resultado de otra), cada una simple y rápida: {question}
+
+    IMPORTANTE - Reglas:
+    - Máximo {MAX_SUBQUERIES} sub-consultas. Si la pregunta es simple, usa una sola.
+    - La tabla se llama 'client_conversion_only_culture'
+    - Los valores concretos (fechas, países) van como parámetros con nombre (:start_date, :culture, etc.), nunca escritos en el SQL
+    - Cada sub-consulta debe retornar un resultado pequeño y agregado (usa GROUP BY, AVG, SUM, etc.)
+    - Para usar ROUND() con campos float/double precision, convierte primero a numeric: ROUND(campo::numeric, 2)
+    - Para evitar división por cero, usa NULLIF: NULLIF(denominador, 0)
+    - Usa SOLO símbolos SQL estándar: >=, <=, =, !=, etc. (NO uses ≥, ≤, ≠)
+    {TABLE_DESCRIPTION}
+    Responde SOLO con un JSON con este formato:
+    {{"subqueries": [{{"description": "conversión CL en junio 2025", "sql": "SELECT SUM(payment_confirmation_loaded) / NULLIF(SUM(traffic), 0) AS conversion FROM client_conversion_only_culture WHERE culture = :culture AND date BETWEEN :start_date AND :end_date", "params": {{"culture": "CL", "start_date": "2025-06-01", "end_date": "2025-06-30"}}}}]}}
+    """
+
+    plan = json.loads(strip_code_fences(call_llm(prompt, temperature=0, response_format={"type": "json_object"})))
+    return plan["subqueries"][:MAX_SUBQUERIES]
+
+def execute_query(sql_query, params=None, engine=None, max_rows=None, timeout_seconds=None):
+    """
+    Ejecuta la consulta SQL y retorna los resultados.
+    Con max_rows se usa un cursor del lado del servidor y se traen solo esas filas, sin cargar el resto en memoria.
+    Con timeout_seconds Postgres cancela la consulta si se demora más, liberando la conexión del pool.
+    """
+    engine = engine or get_db_connection()
     with engine.connect() as conn:
-        result = conn.execute(text(sql_query))
+        if timeout_seconds:
+            # SET LOCAL aplica solo a la transacción de esta consulta, no a la conexión del pool
+            conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout_seconds * 1000)}"))
+        if max_rows:
+            result = conn.execute(text(sql_query), params or {}, execution_options={"stream_results": True})
+            return result.fetchmany(max_rows), result.keys()
+        result = conn.execute(text(sql_query), params or {})
         return result.fetchall(), result.keys()
 
-def generate_natural_response(history, question, sql_query, sql_result, columns):
+def get_subquery_key(sql_query, params):
+    """Llave normalizada de una sub-consulta, para deduplicarlas y cachearlas"""
+    return ' '.join(sql_query.split()), json.dumps(params or {}, sort_keys=True, default=str)
+
+def execute_cached_query(sql_query, params, engine, cache, max_rows=MAX_ROWS_PER_SUBQUERY,
+                         timeout_seconds=SUBQUERY_TIMEOUT_SECONDS):
+    """
+    Ejecuta una consulta usando el cache compartido entre sesiones (cada sub-consulta del plan se cachea por separado).
+    Retorna (rows, columns, truncated), con a lo más max_rows filas (que es lo que se cachea). Con max_rows=None
+    se traen todas las filas y el resultado no se cachea, para no guardar resultados de tamaño arbitrario.
+    """
+    key = get_subquery_key(sql_query, params) + (max_rows,)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    if max_rows:
+        # Se pide una fila extra solo para saber si el resultado quedó truncado
+        rows, columns = execute_query(sql_query, params, engine, max_rows=max_rows + 1, timeout_seconds=timeout_seconds)
+    else:
+        rows, columns = execute_query(sql_query, params, engine, timeout_seconds=timeout_seconds)
+    truncated = bool(max_rows) and len(rows) > max_rows
+    result = ([tuple(row) for row in rows[:max_rows]], list(columns), truncated)
+    if max_rows:
+        cache.set(key, result)
+    return result
+
+def run_timed_subquery(started, *args):
+    """Ejecuta la sub-consulta registrando cuándo empezó realmente (después de esperar en la cola del executor)"""
+    started["at"] = time.time()
+    return execute_cached_query(*args)
+
+def execute_query_plan(plan):
+    """
+    Ejecuta en paralelo las sub-consultas del plan en el executor compartido (máximo MAX_CONCURRENT_SUBQUERIES
+    a la vez entre todas las sesiones), ejecutando una sola vez las repetidas. El error de una sub-consulta
+    no afecta a las demás.
+
+    El tiempo máximo de cada sub-consulta corre desde que empieza a ejecutarse, no desde que entra a la cola;
+    las que no alcanzan a empezar en SUBQUERY_QUEUE_TIMEOUT_SECONDS se cancelan.
+    """
+    unique_subqueries = {}
+    for subquery in plan:
+        key = get_subquery_key(subquery["sql"], subquery.get("params"))
+        unique_subqueries.setdefault(key, subquery)
+
+    # Los recursos compartidos se obtienen en el thread de Streamlit y se pasan a los workers
+    engine = get_db_connection()
+    cache = get_subquery_cache()
+
+    executor = get_subquery_executor()
+    started = {key: {} for key in unique_subqueries}
+    futures = {
+        key: executor.submit(run_timed_subquery, started[key], subquery["sql"], subquery.get("params"), engine, cache)
+        for key, subquery in unique_subqueries.items()
+    }
+    submitted_at = time.time()
+
+    # Sub-consultas que se dejan de esperar: las que no empezaron a tiempo se cancelan; las que ya empezaron
+    # las corta Postgres con statement_timeout, esto es solo un respaldo por si no responde
+    expired = {}
+    pending = set(futures.values())
+    try:
+        while pending:
+            wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            now = time.time()
+            for key, future in futures.items():
+                if future.done() or key in expired:
+                    continue
+                started_at = started[key].get("at")
+                if started_at is None and now - submitted_at > SUBQUERY_QUEUE_TIMEOUT_SECONDS and future.cancel():
+                    expired[key] = f"no alcanzó a ejecutarse tras {SUBQUERY_QUEUE_TIMEOUT_SECONDS} s en cola"
+                elif started_at is not None and now - started_at > SUBQUERY_TIMEOUT_SECONDS + SUBQUERY_TIMEOUT_GRACE_SECONDS:
+                    expired[key] = f"excedió el tiempo máximo de {SUBQUERY_TIMEOUT_SECONDS} s"
+            pending = {future for key, future in futures.items() if not future.done() and key not in expired}
+    except BaseException:
+        # Si Streamlit interrumpe esta ejecución, no dejar en la cola compartida sub-consultas que nadie va a leer
+        for future in futures.values():
+            future.cancel()
+        raise
+
+    subquery_results = []
+    for key, subquery in unique_subqueries.items():
+        result = {"description": subquery.get("description", ""), "sql": subquery["sql"], "params": subquery.get("params") or {}}
+        if key in expired:
+            result.update(rows=[], columns=[], error=expired[key])
+        else:
+            try:
+                rows, columns, truncated = futures[key].result()
+                result.update(rows=rows, columns=columns, truncated=truncated)
+            except Exception as e:
+                result.update(rows=[], columns=[], error=str(e) or type(e).__name__)
+        subquery_results.append(result)
+
+    return subquery_results
+
+def format_plan_sql(subquery_results):
+    """SQL de todas las sub-consultas del plan, para mostrarlo en la interfaz"""
+    return '\n\n'.join([
+        f"-- {r['description']}\n-- params: {json.dumps(r['params'], default=str)}\n{r['sql']}" for r in subquery_results
+    ])
+
+def format_result_text(sql_result, columns):
+    if sql_result:
+        if len(sql_result) == 1 and len(sql_result[0]) == 1:
+            return str(sql_result[0][0])
+        return '\n'.join([
+            ', '.join([f"{col}: {val}" for col, val in zip(columns, row)]) for row in sql_result
+        ])
+    return "No se encontraron resultados."
+
+def generate_natural_response(history, question, sql_query, sql_result, columns, subquery_results=None, truncated=False):
     # Construir historial como texto
     history_text = "\n".join([
         f"Usuario: {h['question']}\nAsistente: {h['answer']}" for h in history
     ])
-    # Formatear resultado SQL
-    if sql_result:
-        if len(sql_result) == 1 and len(sql_result[0]) == 1:
-            result_text = str(sql_result[0][0])
-        else:
-            result_text = '\n'.join([
-                ', '.join([f"{col}: {val}" for col, val in zip(columns, row)]) for row in sql_result
-            ])
+    # Formatear resultado SQL (en modo multi-consulta, un bloque por sub-consulta)
+    if subquery_results is not None:
+        blocks = []
+        for r in subquery_results:
+            if "error" in r:
+                body = f"Error al ejecutar esta consulta: {r['error']}"
+            else:
+                body = format_result_text(r["rows"], r["columns"])
+                if r["truncated"]:
+                    body += f"\n(solo se muestran las primeras {MAX_ROWS_PER_SUBQUERY} filas)"
+            blocks.append(f"[{r['description']}]\n{body}")
+        result_text = '\n\n'.join(blocks)
     else:
-        result_text = "No se encontraron resultados."
+        result_text = format_result_text(sql_result, columns)
+        if truncated:
+            result_text += f"\n(solo se muestran las primeras {MAX_ROWS_PER_QUERY} filas)"
     prompt = f"""
     Eres un asistente de analítica web. Responde en español, de forma clara, amigable y profesional, usando lenguaje natural y explicativo. Si es posible, agrega contexto útil para el usuario.
     Historial de la conversación:
@@ -92,18 +417,18 @@ def generate_natural_response(history, question, sql_query, sql_result, columns)
     Resultado de la consulta: {result_text}
     Responde SOLO la pregunta del usuario, no muestres el SQL ni detalles técnicos salvo que sea relevante para la explicación.
     """
-    response = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3
-    )
-    return response.choices[0].message.content.strip()
+    return call_llm(prompt, temperature=0.3).strip()
 
 def main():
     st.set_page_config(page_title="Agente RAG de Métricas Web", page_icon="🧠", layout="centered")
     st.title("🧠 Agente RAG de Métricas Web")
     st.write("Haz preguntas sobre tus métricas de tráfico y conversión. Ejemplo: ¿Cuánto tráfico tuvimos el 5 de enero en CL?")
 
+    multi_query = st.sidebar.toggle(
+        "Modo multi-consulta",
+        help="Para preguntas compuestas: divide la pregunta en sub-consultas independientes que se ejecutan en paralelo"
+    )
+
     # Inicializar historial en session_state
     if "chat_history" not in st.session_state:
         st.session_state.chat_history = []
@@ -123,9 +448,19 @@ def main():
         with st.chat_message("user"):
             st.markdown(question)
         try:
-            sql_query = generate_sql_query(question)
-            sql_result, columns = execute_query(sql_query)
-            answer = generate_natural_response(st.session_state.chat_history, question, sql_query, sql_result, columns)
+            if multi_query:
+                plan = generate_query_plan(question)
+                subquery_results = execute_query_plan(plan)
+                sql_query = format_plan_sql(subquery_results)
+                answer = generate_natural_response(st.session_state.chat_history, question, sql_query, None, None,
+                                                   subquery_results=subquery_results)
+            else:
+                sql_query = generate_sql_query(question)
+                # Misma consulta en otra sesión (o repetida) -> se reutiliza el resultado del cache compartido
+                sql_result, columns, truncated = execute_cached_query(sql_query, None, get_db_connection(), get_subquery_cache(),
+                                                                      max_rows=MAX_ROWS_PER_QUERY, timeout_seconds=None)
+                answer = generate_natural_response(st.session_state.chat_history, question, sql_query, sql_result, columns,
+                                                   truncated=truncated)
             with st.chat_message("assistant"):
                 st.markdown(answer)
                 with st.expander("Ver SQL generado"):